@@ -3,14 +3,19 @@
 Shell Assistant Agent - Natural language command translation and interactive shell help
 """
 
+import array
 import asyncio
 import json
 import os
 import re
 import subprocess
+import sys
 import time
+from collections import deque
 from datetime import datetime, timedelta
+from itertools import compress
 from pathlib import Path
+from types import MappingProxyType
 from typing import Dict, List, Optional, Tuple
 import shlex
 
@@ -21,13 +26,104 @@ except ImportError:
     OLLAMA_AVAILABLE = False
 
 try:
-    import GPUtil
+    import pynvml
     GPU_AVAILABLE = True
 except ImportError:
     GPU_AVAILABLE = False
 
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
 from .base_agent import BaseAgent, AgentMessage, MessageType, AgentState
 
+# Sentinel for lazily computed values that may legitimately be None
+_UNSET = object()
+
+# Version line printed by `nvcc --version`
+_NVCC_RE = re.compile(r'release (\d+\.\d+)')
+
+# Rule-based explanations for common commands (prefix -> explanation)
+_EXPLANATIONS = MappingProxyType({sys.intern(k): v for k, v in {
+    'ls': "Lists files and directories in the current location",
+    'ls -l': "Lists files with detailed information (permissions, size, date)",
+    'ls -la': "Lists all files including hidden ones with detailed information",
+    'pwd': "Shows the current directory path",
+    'cd': "Changes the current directory",
+    'mkdir': "Creates a new directory",
+    'rm': "Removes/deletes files or directories",
+    'cp': "Copies files or directories",
+    'mv': "Moves or renames files or directories",
+    'chmod': "Changes file permissions",
+    'chown': "Changes file ownership",
+    'df -h': "Shows disk space usage in human-readable format",
+    'free -h': "Shows memory usage in human-readable format",
+    'top': "Shows running processes and system resource usage",
+    'ps aux': "Shows all running processes",
+    'grep': "Searches for text patterns in files",
+    'find': "Searches for files and directories",
+    'wget': "Downloads files from the internet",
+    'curl': "Transfers data to/from servers",
+    'tar': "Archives and compresses files",
+    'zip': "Creates compressed archives",
+    'unzip': "Extracts compressed archives",
+    'ssh': "Connects to remote systems securely",
+    'scp': "Copies files securely between systems",
+    'sudo': "Executes commands with administrator privileges",
+    'pip3 install': "Installs Python packages",
+    'python3': "Runs Python scripts or starts Python interpreter",
+    'nvidia-smi': "Shows GPU status and usage information"
+}.items()})
+
+# Usage examples keyed by base command
+_EXAMPLES_DB = MappingProxyType({sys.intern(k): tuple(v) for k, v in {
+    'ls': ['ls', 'ls -l', 'ls -la', 'ls *.txt'],
+    'cd': ['cd /home/user', 'cd ..', 'cd ~', 'cd /'],
+    'mkdir': ['mkdir newdir', 'mkdir -p path/to/dir'],
+    'rm': ['rm file.txt', 'rm -r directory/', 'rm *.tmp'],
+    'cp': ['cp file1.txt file2.txt', 'cp -r dir1/ dir2/'],
+    'mv': ['mv oldname newname', 'mv file.txt /path/to/destination/'],
+    'find': ['find . -name "*.py"', 'find /home -type f -size +100M'],
+    'grep': ['grep "pattern" file.txt', 'grep -r "text" .'],
+    'chmod': ['chmod 755 script.sh', 'chmod u+x file'],
+    'tar': ['tar -czf archive.tar.gz files/', 'tar -xzf archive.tar.gz'],
+    'pip3': ['pip3 install numpy', 'pip3 list', 'pip3 uninstall package']
+}.items()})
+
+
+def _read_history(path: Path) -> List[Dict]:
+    """Read previously persisted history entries (runs in a worker thread)"""
+    try:
+        data = path.read_bytes()
+    except FileNotFoundError:
+        return []
+    
+    try:
+        entries = orjson.loads(data) if ORJSON_AVAILABLE else json.loads(data)
+    except ValueError:
+        entries = None
+    
+    if not isinstance(entries, list):
+        # Keep the unreadable file for inspection instead of overwriting it
+        os.replace(path, path.with_name(path.name + '.corrupt'))
+        raise ValueError(f"unreadable history file moved to {path.name}.corrupt")
+    return entries
+
+
+def _write_history(path: Path, entries: List[Dict]):
+    """Write history entries to disk (runs in a worker thread)"""
+    if ORJSON_AVAILABLE:
+        data = orjson.dumps(entries, default=str)
+    else:
+        data = json.dumps(entries, default=str).encode()
+    
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    tmp_path.write_bytes(data)
+    os.replace(tmp_path, path)
+
 
 class CommandSuggestion:
     """Data structure for command suggestions"""
@@ -43,6 +139,15 @@ class CommandSuggestion:
 class ShellAssistantAgent(BaseAgent):
     """Agent for natural language shell command translation and assistance"""
     
+    # Single-pass dispatch for structural command explanations
+    _DISPATCH_RE = re.compile(r'^(?P<op>cd|mkdir|rm|chmod) (?P<arg>.*)$', re.DOTALL)
+    _STRUCTURAL_EXPLANATIONS = {
+        'cd': lambda arg: f"Changes directory to '{arg}'",
+        'mkdir': lambda arg: f"Creates a new directory named '{arg}'",
+        'rm': lambda arg: "Removes (deletes) the specified files or directories",
+        'chmod': lambda arg: "Changes file permissions for the specified files"
+    }
+    
     def __init__(self, agent_id: str, security_manager, config: Dict):
         super().__init__(agent_id, security_manager, config)
         self.name = "Shell Assistant Agent"
@@ -55,12 +160,22 @@ class ShellAssistantAgent(BaseAgent):
             "auto_execute": config.get('auto_execute', False),
             "context_aware": config.get('context_aware', True),
             "beginner_mode": config.get('beginner_mode', True),
-            "shell_type": config.get('shell_type', 'bash')  # bash, zsh, fish
+            "shell_type": config.get('shell_type', 'bash'),  # bash, zsh, fish
+            "history_path": Path(config.get('history_path', Path.home() / ".ai_shell_assistant_history.json")),
+            "history_flush_every": config.get('history_flush_every', 100),  # commands
+            "history_flush_interval": config.get('history_flush_interval', 60)  # seconds
         }
         
         # Command history and context
         self.command_history = []
         self.conversation_context = []
+        self._history_ring = deque(maxlen=10_000)  # Persisted history, flushed off the event loop
+        self._dirty_since_flush = 0
+        self._history_loaded = False  # Earlier sessions' entries are merged in before the first write
+        self._last_history_flush = time.time()
+        self._history_flush_task = None
+        self._context_tail = deque(maxlen=5)  # Rendered lines of the last 5 interactions
+        self._context_cache = None
         self.current_directory = os.getcwd()
         self.environment_state = dict(os.environ)
         
@@ -80,15 +195,42 @@ class ShellAssistantAgent(BaseAgent):
             r'wget.*\|\s*sh',
             r'curl.*\|\s*sh',
         ]
+        self._dangerous_regexes = [re.compile(p, re.IGNORECASE) for p in self.dangerous_patterns]
         
         # Command templates for AI/ML workflows
         self.ml_templates = self._load_ml_templates()
         
         # Learning mode suggestions
         self.beginner_suggestions = self._load_beginner_suggestions()
+        self._build_suggestion_tables()
+        
+        # GPU handles (NVML is initialized once; only volatile fields are polled)
+        self._nvml_initialized = False
+        self._nvml_devices = []
+        if GPU_AVAILABLE:
+            self._init_nvml()
+        
+        # CUDA version is detected once per process (None is cached too)
+        self._cuda_version = _UNSET
         
         self.logger.info("Shell Assistant Agent initialized")
     
+    def _init_nvml(self):
+        """Initialize NVML and cache per-device handles and static names"""
+        try:
+            pynvml.nvmlInit()
+            self._nvml_initialized = True
+            
+            for index in range(pynvml.nvmlDeviceGetCount()):
+                handle = pynvml.nvmlDeviceGetHandleByIndex(index)
+                name = pynvml.nvmlDeviceGetName(handle)
+                if isinstance(name, bytes):
+                    name = name.decode()
+                self._nvml_devices.append((index, handle, name))
+        except Exception as e:
+            self.logger.debug(f"NVML initialization failed: {e}")
+            self._nvml_devices = []
+    
     def _load_ml_templates(self) -> Dict:
         """Load AI/ML command templates"""
         return {
@@ -164,6 +306,32 @@ print('MNIST downloaded to ./data/')
             ]
         }
     
+    # Category bits for the suggestion mask column, in suggestion priority order
+    _SUGGESTION_CATEGORIES = (
+        ('file_operations', ('file',)),
+        ('navigation', ('directory', 'folder')),
+        ('system_info', ('system', 'info')),
+        ('ai_ml', ('gpu', 'ai', 'ml'))
+    )
+    
+    def _build_suggestion_tables(self):
+        """Flatten beginner suggestions into parallel columns with a category bitmask"""
+        commands, descriptions, safety, examples, masks = [], [], [], [], []
+        
+        for bit, (category, _) in enumerate(self._SUGGESTION_CATEGORIES):
+            for suggestion in self.beginner_suggestions.get(category, []):
+                commands.append(suggestion.command)
+                descriptions.append(suggestion.description)
+                safety.append(suggestion.safety_level)
+                examples.append(suggestion.examples)
+                masks.append(1 << bit)
+        
+        self._sug_cmd = tuple(commands)
+        self._sug_desc = tuple(descriptions)
+        self._sug_safety = tuple(safety)
+        self._sug_examples = tuple(examples)
+        self._sug_mask = array.array('I', masks)
+    
     async def process_message(self, message: AgentMessage) -> Optional[Dict]:
         """Process shell assistance requests"""
         try:
@@ -243,7 +411,7 @@ print('MNIST downloaded to ./data/')
             query_lower = query.lower().strip()
             
             # Add to conversation context
-            self.conversation_context.append({
+            self._add_context({
                 'timestamp': datetime.now(),
                 'user_input': query,
                 'type': 'request'
@@ -270,7 +438,7 @@ print('MNIST downloaded to ./data/')
             safety_result = await self._check_command_safety(command)
             
             # Add to context
-            self.conversation_context.append({
+            self._add_context({
                 'timestamp': datetime.now(),
                 'command': command,
                 'safety': safety_result,
@@ -583,11 +751,11 @@ Recent conversation context:
         command_lower = command.lower()
         
         # Check for dangerous patterns
-        for pattern in self.dangerous_patterns:
-            if re.search(pattern, command, re.IGNORECASE):
+        for regex in self._dangerous_regexes:
+            if regex.search(command):
                 safety_result['level'] = 'dangerous'
                 safety_result['requires_confirmation'] = True
-                safety_result['warnings'].append(f"Potentially dangerous command detected: {pattern}")
+                safety_result['warnings'].append(f"Potentially dangerous command detected: {regex.pattern}")
         
         # Check for specific dangerous operations
         if any(word in command_lower for word in ['rm', 'delete', 'format', 'fdisk']):
@@ -652,13 +820,15 @@ Recent conversation context:
             execution_time = time.time() - start_time
             
             # Store in history
-            self.command_history.append({
+            history_entry = {
                 'timestamp': datetime.now(),
                 'command': command,
                 'exit_code': process.returncode,
                 'execution_time': execution_time,
                 'success': process.returncode == 0
-            })
+            }
+            self.command_history.append(history_entry)
+            self._record_history(history_entry)
             
             # Limit history size
             if len(self.command_history) > self.shell_config['max_history']:
@@ -681,6 +851,46 @@ Recent conversation context:
                 "error": str(e)
             }
     
+    def _record_history(self, entry: Dict):
+        """Queue a history entry for persistence, flushing every N commands or T seconds"""
+        self._history_ring.append(entry)
+        self._dirty_since_flush += 1
+        
+        due = (
+            self._dirty_since_flush >= self.shell_config['history_flush_every'] or
+            time.time() - self._last_history_flush >= self.shell_config['history_flush_interval']
+        )
+        if due and (self._history_flush_task is None or self._history_flush_task.done()):
+            self._history_flush_task = asyncio.create_task(self._flush_history())
+    
+    async def _flush_history(self):
+        """Persist the history ring in a worker thread"""
+        if not self._dirty_since_flush:
+            return
+        
+        path = self.shell_config['history_path']
+        self._last_history_flush = time.time()
+        
+        try:
+            loop = asyncio.get_running_loop()
+            if not self._history_loaded:
+                # Keep earlier sessions' history instead of replacing the file with this one's
+                try:
+                    previous = await loop.run_in_executor(None, _read_history, path)
+                except (OSError, ValueError) as e:
+                    self.logger.warning(f"Could not load previous command history: {e}")
+                    previous = []
+                self._history_ring = deque([*previous, *self._history_ring], maxlen=self._history_ring.maxlen)
+                self._history_loaded = True
+            
+            entries = list(self._history_ring)
+            dirty = self._dirty_since_flush
+            await loop.run_in_executor(None, _write_history, path, entries)
+            # Entries recorded during the write stay dirty for the next flush
+            self._dirty_since_flush -= dirty
+        except Exception as e:
+            self.logger.error(f"Failed to persist command history: {e}")
+    
     async def _explain_command(self, command: str) -> Dict:
         """Explain what a command does"""
         try:
@@ -703,57 +913,15 @@ Recent conversation context:
     async def _generate_explanation(self, command: str) -> str:
         """Generate explanation for a command"""
         
-        # Rule-based explanations for common commands
-        explanations = {
-            'ls': "Lists files and directories in the current location",
-            'ls -l': "Lists files with detailed information (permissions, size, date)",
-            'ls -la': "Lists all files including hidden ones with detailed information",
-            'pwd': "Shows the current directory path",
-            'cd': "Changes the current directory",
-            'mkdir': "Creates a new directory",
-            'rm': "Removes/deletes files or directories",
-            'cp': "Copies files or directories",
-            'mv': "Moves or renames files or directories",
-            'chmod': "Changes file permissions",
-            'chown': "Changes file ownership",
-            'df -h': "Shows disk space usage in human-readable format",
-            'free -h': "Shows memory usage in human-readable format",
-            'top': "Shows running processes and system resource usage",
-            'ps aux': "Shows all running processes",
-            'grep': "Searches for text patterns in files",
-            'find': "Searches for files and directories",
-            'wget': "Downloads files from the internet",
-            'curl': "Transfers data to/from servers",
-            'tar': "Archives and compresses files",
-            'zip': "Creates compressed archives",
-            'unzip': "Extracts compressed archives",
-            'ssh': "Connects to remote systems securely",
-            'scp': "Copies files securely between systems",
-            'sudo': "Executes commands with administrator privileges",
-            'pip3 install': "Installs Python packages",
-            'python3': "Runs Python scripts or starts Python interpreter",
-            'nvidia-smi': "Shows GPU status and usage information"
-        }
-        
         # Check for exact matches first
-        for cmd, explanation in explanations.items():
+        for cmd, explanation in _EXPLANATIONS.items():
             if command.startswith(cmd):
                 return explanation
         
         # Generate explanation based on command structure
-        if command.startswith('cd '):
-            path = command[3:].strip()
-            return f"Changes directory to '{path}'"
-        
-        elif command.startswith('mkdir '):
-            dir_name = command[6:].strip()
-            return f"Creates a new directory named '{dir_name}'"
-        
-        elif command.startswith('rm '):
-            return "Removes (deletes) the specified files or directories"
-        
-        elif command.startswith('chmod '):
-            return "Changes file permissions for the specified files"
+        match = self._DISPATCH_RE.match(command)
+        if match:
+            return self._STRUCTURAL_EXPLANATIONS[match.group('op')](match.group('arg').strip())
         
         # Fallback explanation
         return f"Executes the command: {command}"
@@ -761,116 +929,134 @@ Recent conversation context:
     async def _break_down_command(self, command: str) -> Dict:
         """Break down command into components"""
         try:
-            parts = shlex.split(command)
+            # Only quoted/escaped input needs the full shlex state machine
+            if '"' in command or "'" in command or '\\' in command:
+                parts = shlex.split(command)
+            else:
+                parts = command.split()
             if not parts:
                 return {"components": []}
             
-            breakdown = {
+            args = parts[1:]
+            is_flag = [arg[:1] == '-' for arg in args]
+            return {
                 "command": parts[0],
-                "arguments": parts[1:] if len(parts) > 1 else [],
-                "flags": [],
-                "parameters": []
+                "arguments": args,
+                "flags": list(compress(args, is_flag)),
+                "parameters": list(compress(args, [not flag for flag in is_flag]))
             }
             
-            for arg in parts[1:]:
-                if arg.startswith('-'):
-                    breakdown["flags"].append(arg)
-                else:
-                    breakdown["parameters"].append(arg)
-            
-            return breakdown
-            
         except Exception as e:
             return {"error": str(e)}
     
-    async def _get_command_examples(self, command: str) -> List[str]:
+    async def _get_command_examples(self, command: str) -> Tuple[str, ...]:
         """Get usage examples for a command"""
-        base_cmd = command.split()[0] if command else ""
-        
-        examples_db = {
-            'ls': ['ls', 'ls -l', 'ls -la', 'ls *.txt'],
-            'cd': ['cd /home/user', 'cd ..', 'cd ~', 'cd /'],
-            'mkdir': ['mkdir newdir', 'mkdir -p path/to/dir'],
-            'rm': ['rm file.txt', 'rm -r directory/', 'rm *.tmp'],
-            'cp': ['cp file1.txt file2.txt', 'cp -r dir1/ dir2/'],
-            'mv': ['mv oldname newname', 'mv file.txt /path/to/destination/'],
-            'find': ['find . -name "*.py"', 'find /home -type f -size +100M'],
-            'grep': ['grep "pattern" file.txt', 'grep -r "text" .'],
-            'chmod': ['chmod 755 script.sh', 'chmod u+x file'],
-            'tar': ['tar -czf archive.tar.gz files/', 'tar -xzf archive.tar.gz'],
-            'pip3': ['pip3 install numpy', 'pip3 list', 'pip3 uninstall package']
-        }
-        
-        return examples_db.get(base_cmd, [])
+        words = command.split(None, 1)
+        if not words:
+            return ()
+        return _EXAMPLES_DB.get(sys.intern(words[0]), ())
     
     async def _get_gpu_info(self) -> List[Dict]:
         """Get GPU information"""
         try:
-            if not GPU_AVAILABLE:
+            if not self._nvml_devices:
                 return []
             
-            gpus = GPUtil.getGPUs()
-            return [{
-                'id': gpu.id,
-                'name': gpu.name,
-                'memory_total': gpu.memoryTotal,
-                'memory_used': gpu.memoryUsed,
-                'load': gpu.load,
-                'temperature': gpu.temperature
-            } for gpu in gpus]
+            gpus = []
+            for index, handle, name in self._nvml_devices:
+                utilization = pynvml.nvmlDeviceGetUtilizationRates(handle)
+                memory = pynvml.nvmlDeviceGetMemoryInfo(handle)
+                gpus.append({
+                    'id': index,
+                    'name': name,
+                    'memory_total': memory.total / 1024 / 1024,
+                    'memory_used': memory.used / 1024 / 1024,
+                    'load': utilization.gpu / 100.0,
+                    'temperature': pynvml.nvmlDeviceGetTemperature(handle, pynvml.NVML_TEMPERATURE_GPU)
+                })
+            return gpus
         except:
             return []
     
     async def _get_cuda_version(self) -> Optional[str]:
-        """Get CUDA version"""
+        """Get CUDA version (detected once and cached)"""
+        if self._cuda_version is _UNSET:
+            self._cuda_version = self._detect_cuda_version()
+        return self._cuda_version
+    
+    def _detect_cuda_version(self) -> Optional[str]:
+        """Detect CUDA version, preferring NVML and version.json over forking nvcc"""
+        if self._nvml_initialized:
+            try:
+                version = pynvml.nvmlSystemGetCudaDriverVersion()
+                return f"{version // 1000}.{(version % 1000) // 10}"
+            except Exception:
+                pass
+        
+        try:
+            with open('/usr/local/cuda/version.json') as f:
+                version = json.load(f)['cuda']['version']
+            return '.'.join(version.split('.')[:2])
+        except Exception:
+            pass
+        
         try:
             result = subprocess.run(['nvcc', '--version'], capture_output=True, text=True)
             if result.returncode == 0:
-                version_match = re.search(r'release (\d+\.\d+)', result.stdout)
+                version_match = _NVCC_RE.search(result.stdout)
                 if version_match:
                     return version_match.group(1)
         except:
             pass
         return None
     
+    def _add_context(self, item: Dict):
+        """Record a conversation item and update the rendered context tail"""
+        self.conversation_context.append(item)
+        
+        if item['type'] == 'request':
+            self._context_tail.append(f"User: {item['user_input']}")
+        elif item['type'] == 'response':
+            self._context_tail.append(f"Command: {item['command']}")
+        self._context_cache = None
+    
     def _format_conversation_context(self) -> str:
         """Format recent conversation context"""
         if not self.conversation_context:
             return "No recent context"
         
-        context_lines = []
-        for item in self.conversation_context[-5:]:  # Last 5 interactions
-            if item['type'] == 'request':
-                context_lines.append(f"User: {item['user_input']}")
-            elif item['type'] == 'response':
-                context_lines.append(f"Command: {item['command']}")
-        
-        return '\n'.join(context_lines)
+        if self._context_cache is None:
+            self._context_cache = '\n'.join(self._context_tail)  # Last 5 interactions
+        return self._context_cache
     
-    async def _get_similar_commands(self, query: str) -> List[Dict]:
+    async def _get_similar_commands(self, query: str, limit: int = 5) -> List[Dict]:
         """Get similar commands based on query"""
         # Simple keyword matching for suggestions
+        query_mask = 0
+        for bit, (_, keywords) in enumerate(self._SUGGESTION_CATEGORIES):
+            if any(keyword in query for keyword in keywords):
+                query_mask |= 1 << bit
+        
+        if not query_mask:
+            return []
+        
         suggestions = []
+        seen = set()
+        for i, mask in enumerate(self._sug_mask):
+            if not mask & query_mask or self._sug_cmd[i] in seen:
+                continue
+            
+            seen.add(self._sug_cmd[i])
+            suggestions.append({
+                "command": self._sug_cmd[i],
+                "description": self._sug_desc[i],
+                "safety": self._sug_safety[i],
+                "examples": self._sug_examples[i]
+            })
+            if len(suggestions) >= limit:
+                break
         
-        if "file" in query:
-            suggestions.extend(self.beginner_suggestions['file_operations'])
-        if "directory" in query or "folder" in query:
-            suggestions.extend(self.beginner_suggestions['navigation'])
-        if "system" in query or "info" in query:
-            suggestions.extend(self.beginner_suggestions['system_info'])
-        if "gpu" in query or "ai" in query or "ml" in query:
-            suggestions.extend(self.beginner_suggestions['ai_ml'])
-        
-        # Convert to dict format
-        return [
-            {
-                "command": s.command,
-                "description": s.description,
-                "safety": s.safety_level,
-                "examples": s.examples
-            }
-            for s in suggestions[:5]  # Limit to 5 suggestions
-        ]
+        return suggestions
     
     async def get_status(self) -> Dict:
         """Get agent status"""
@@ -887,6 +1073,17 @@ Recent conversation context:
     
     async def cleanup(self):
         """Cleanup agent resources"""
-        # Save command history if needed
-        # Could implement persistent history storage here
+        # Save command history
+        if self._history_flush_task is not None:
+            await self._history_flush_task
+        await self._flush_history()
+        
+        if self._nvml_initialized:
+            try:
+                pynvml.nvmlShutdown()
+            except Exception:
+                pass
+            self._nvml_initialized = False
+            self._nvml_devices = []
+        
         await super().cleanup() 
\ No newline at end of file
@@ -4,75 +4,136 @@ Software Install Agent - Enhanced with async processing and efficiency improveme
 """
 
 import asyncio
+import functools
+import graphlib
 import json
 import os
+import re
+import shlex
+import signal
 import subprocess
+import sys
 import time
+from collections import deque, namedtuple
+from dataclasses import dataclass
 from datetime import datetime
 from pathlib import Path
-from typing import Dict, List, Optional, Tuple, Any
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Optional, Tuple
 import shutil
 import logging
 
 from .base_agent import BaseAgent
 
+try:
+    import aiohttp
+    AIOHTTP_AVAILABLE = True
+except ImportError:
+    AIOHTTP_AVAILABLE = False
+
+try:
+    import ahocorasick
+    AHOCORASICK_AVAILABLE = True
+except ImportError:
+    AHOCORASICK_AVAILABLE = False
+
+try:
+    import orjson
+    ORJSON_AVAILABLE = True
+except ImportError:
+    ORJSON_AVAILABLE = False
+
+# Package name extraction patterns, compiled once at import time
+_PKG_PATTERNS = [
+    re.compile(r'install\s+(\S+)', re.IGNORECASE),
+    re.compile(r'remove\s+(\S+)', re.IGNORECASE),
+    re.compile(r'search\s+(\S+)', re.IGNORECASE),
+    re.compile(r'verify\s+(\S+)', re.IGNORECASE)
+]
+_PKG_LIST_RE = re.compile(r'(?:install|remove)\s+(.+)', re.IGNORECASE)
+_PKG_SPLIT_RE = re.compile(r'[\s,]+')
+_PKG_NAME_RE = re.compile(r'[A-Za-z0-9][A-Za-z0-9+._:=@-]*$')
+# Words that end the package list ("install vim on my system") or can be skipped in it
+_PKG_LIST_STOPWORDS = frozenset({'on', 'in', 'for', 'to', 'from', 'with', 'using', 'via', 'into', 'onto', 'so'})
+_PKG_LIST_FILLER = frozenset({'and', 'a', 'an', 'the', 'package', 'packages', 'please', 'also', 'too', 'now'})
+# Unanchored on purpose: the rule router matches substrings, so the gate must too
+_DANGEROUS_RE = re.compile(r'remove|uninstall|purge|upgrade', re.IGNORECASE)
+# Version extraction from each template's verify output
+_VERIFY_RE = {
+    'docker': re.compile(r'Docker version ([^,\s]+)'),
+    'nodejs': re.compile(r'v?(\d+\.\d+\.\d+)'),
+    'python': re.compile(r'Python (\S+)'),
+    'java': re.compile(r'version "([^"]+)"'),
+    'git': re.compile(r'git version (\S+)')
+}
+# Substring matches like the original dispatch ('node' covers node.js, 'python' covers python3);
+# 'git' is anchored so words such as 'digital' don't select it
+# A $VAR left behind by os.path.expandvars, i.e. one that isn't set
+_UNSET_VAR_RE = re.compile(r'\$(\w+|\{[^}]*\})')
+_LLM_RE = re.compile(r'docker|node|python|java|\bgit\b', re.IGNORECASE)
+
 
 class PackageManager:
     """Package manager detection and abstraction"""
     
+    # Commands are stored as argv fragments so they can be exec'd without a shell
     MANAGERS = {
         'apt': {
-            'install': 'apt install -y',
-            'remove': 'apt remove -y',
-            'update': 'apt update',
-            'upgrade': 'apt upgrade -y',
-            'search': 'apt search',
-            'list': 'apt list --installed',
-            'check': 'dpkg -s'
+            'install': ('apt', 'install', '-y'),
+            'remove': ('apt', 'remove', '-y'),
+            'update': ('apt', 'update'),
+            'upgrade': ('apt', 'upgrade', '-y'),
+            'search': ('apt', 'search'),
+            'list': ('apt', 'list', '--installed'),
+            'check': ('dpkg', '-s'),
+            'query': ('dpkg-query', '-W', '-f=${Package} ${Status}\\n'),
+            'installed': ('dpkg-query', '-W', '-f=${Package} ${Status}\\n')
         },
         'yum': {
-            'install': 'yum install -y',
-            'remove': 'yum remove -y',
-            'update': 'yum update',
-            'upgrade': 'yum upgrade -y',
-            'search': 'yum search',
-            'list': 'yum list installed',
-            'check': 'rpm -q'
+            'install': ('yum', 'install', '-y'),
+            'remove': ('yum', 'remove', '-y'),
+            'update': ('yum', 'update'),
+            'upgrade': ('yum', 'upgrade', '-y'),
+            'search': ('yum', 'search'),
+            'list': ('yum', 'list', 'installed'),
+            'check': ('rpm', '-q'),
+            'query': ('rpm', '-q', '--qf', '%{NAME}\\n'),
+            'installed': ('rpm', '-qa', '--qf', '%{NAME}\\n')
         },
         'dnf': {
-            'install': 'dnf install -y',
-            'remove': 'dnf remove -y',
-            'update': 'dnf update',
-            'upgrade': 'dnf upgrade -y',
-            'search': 'dnf search',
-            'list': 'dnf list installed',
-            'check': 'rpm -q'
+            'install': ('dnf', 'install', '-y'),
+            'remove': ('dnf', 'remove', '-y'),
+            'update': ('dnf', 'update'),
+            'upgrade': ('dnf', 'upgrade', '-y'),
+            'search': ('dnf', 'search'),
+            'list': ('dnf', 'list', 'installed'),
+            'check': ('rpm', '-q'),
+            'query': ('rpm', '-q', '--qf', '%{NAME}\\n'),
+            'installed': ('rpm', '-qa', '--qf', '%{NAME}\\n')
         },
         'pacman': {
-            'install': 'pacman -S --noconfirm',
-            'remove': 'pacman -R --noconfirm',
-            'update': 'pacman -Sy',
-            'upgrade': 'pacman -Syu --noconfirm',
-            'search': 'pacman -Ss',
-            'list': 'pacman -Q',
-            'check': 'pacman -Q'
+            'install': ('pacman', '-S', '--noconfirm'),
+            'remove': ('pacman', '-R', '--noconfirm'),
+            'update': ('pacman', '-Sy'),
+            'upgrade': ('pacman', '-Syu', '--noconfirm'),
+            'search': ('pacman', '-Ss'),
+            'list': ('pacman', '-Q'),
+            'check': ('pacman', '-Q'),
+            'query': ('pacman', '-Q'),
+            'installed': ('pacman', '-Qq')
         }
     }
     
     @classmethod
     def detect_package_manager(cls) -> Dict[str, bool]:
-        """Detect available package managers"""
-        available = {}
-        
-        for manager in cls.MANAGERS.keys():
-            available[manager] = shutil.which(manager) is not None
-        
-        return available
+        """Detect available package managers (cached per PATH value)"""
+        return dict(_detect_package_managers(os.environ.get('PATH', '')))
     
     @classmethod
-    def get_primary_manager(cls) -> Tuple[str, Dict]:
+    def get_primary_manager(cls, available: Optional[Dict[str, bool]] = None) -> Tuple[str, Dict]:
         """Get the primary package manager for the system"""
-        available = cls.detect_package_manager()
+        if available is None:
+            available = cls.detect_package_manager()
         
         # Priority order
         priority = ['apt', 'dnf', 'yum', 'pacman']
@@ -82,12 +143,320 @@ class PackageManager:
                 return manager, cls.MANAGERS[manager]
         
         return 'apt', cls.MANAGERS['apt']  # Default fallback
+    
+    @classmethod
+    def get_batch_check_command(cls, manager: str, package_names: List[str]) -> List[str]:
+        """Build one query argv that reports the install state of all packages"""
+        return [*cls.MANAGERS[manager]['query'], *package_names]
+    
+    @classmethod
+    def parse_batch_check_output(cls, manager: str, output: str) -> set:
+        """Parse batched query output into the set of installed package names"""
+        installed = set()
+        
+        for line in output.splitlines():
+            if manager == 'apt':
+                # "<package> install ok installed"
+                name, _, status = line.partition(' ')
+                if status == 'install ok installed':
+                    installed.add(name)
+            elif line and 'is not installed' not in line:
+                # rpm prints the bare name, pacman prints "<name> <version>"
+                installed.add(line.split()[0])
+        
+        return installed
+
+
+# argv prefixes of template steps that only install packages
+_INSTALL_PREFIXES = (
+    ('sudo', 'apt', 'install', '-y'),
+    ('sudo', 'apt-get', 'install', '-y'),
+    ('sudo', 'dnf', 'install', '-y'),
+    ('sudo', 'yum', 'install', '-y'),
+    ('sudo', 'pacman', '-S', '--noconfirm')
+)
+
+# Package databases whose mtime changes whenever packages are installed or removed
+_PACKAGE_DB_PATHS = {
+    'apt': ('/var/lib/dpkg/status',),
+    # rpm rewrites its database in place, so stat the file rather than the directory
+    'yum': ('/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/Packages'),
+    'dnf': ('/var/lib/rpm/rpmdb.sqlite', '/var/lib/rpm/Packages'),
+    'pacman': ('/var/lib/pacman/local',)
+}
+
+# Privileged package-manager commands that take the same database lock
+_MANAGER_LOCK_GROUPS = {
+    'apt': 'dpkg',
+    'apt-get': 'dpkg',
+    'dpkg': 'dpkg',
+    'dnf': 'rpm',
+    'yum': 'rpm',
+    'rpm': 'rpm',
+    'pacman': 'pacman'
+}
+
+# Template steps that only refresh package metadata
+_UPDATE_COMMANDS = frozenset({
+    ('sudo', 'apt', 'update'),
+    ('sudo', 'apt-get', 'update'),
+    ('sudo', 'dnf', 'makecache'),
+    ('sudo', 'yum', 'makecache'),
+    ('sudo', 'pacman', '-Sy')
+})
+
+
+def _merge_install_steps(level: List[Any]) -> List[Any]:
+    """Fold independent install steps that share a manager into a single invocation
+    
+    Steps in one level are independent, and concurrent installs would only
+    contend for the package manager lock anyway.
+    """
+    merged = []
+    by_prefix = {}
+    
+    for step in level:
+        prefix = None
+        if not isinstance(step, Download):
+            prefix = next((p for p in _INSTALL_PREFIXES if tuple(step[:len(p)]) == p), None)
+        
+        if prefix is None:
+            merged.append(step)
+        elif prefix in by_prefix:
+            by_prefix[prefix].extend(step[len(prefix):])
+        else:
+            # Copy so the template itself is never modified
+            by_prefix[prefix] = list(step)
+            merged.append(by_prefix[prefix])
+    
+    return merged
+
+
+def _write_json(path: Path, data: Any):
+    """Atomically write JSON to disk (runs in a worker thread)"""
+    path.parent.mkdir(parents=True, exist_ok=True)
+    tmp_path = path.with_name(path.name + '.tmp')
+    if ORJSON_AVAILABLE:
+        payload = orjson.dumps(data)
+    else:
+        payload = json.dumps(data).encode()
+    tmp_path.write_bytes(payload)
+    os.replace(tmp_path, path)
+
+
+@dataclass
+class InstallResult:
+    """Outcome of an install handler; failures are returned rather than raised"""
+    ok: bool
+    message: str
+
+
+# A template step is either an argv tuple or a Download
+Download = namedtuple('Download', 'url dest')
+
+# depends_on holds the indices of the steps each command waits for (default: the previous step)
+Template = namedtuple('Template', 'name commands verify post_install depends_on', defaults=(None, None))
+
+# Installation templates for common software, shared by every agent instance
+INSTALL_TEMPLATES = MappingProxyType({
+    'docker': Template(
+        name='Docker',
+        commands=(
+            Download('https://get.docker.com', 'get-docker.sh'),
+            ('sudo', 'apt', 'update'),
+            ('sudo', 'sh', 'get-docker.sh'),
+            ('sudo', 'usermod', '-aG', 'docker', '$USER')
+        ),
+        depends_on=((), (), (0, 1), (2,)),
+        verify=('docker', '--version'),
+        post_install=('sudo', 'systemctl', 'enable', 'docker')
+    ),
+    'nodejs': Template(
+        name='Node.js',
+        commands=(
+            Download('https://deb.nodesource.com/setup_lts.x', 'nodesource_setup.sh'),
+            ('sudo', '-E', 'bash', 'nodesource_setup.sh'),
+            ('sudo', 'apt-get', 'install', '-y', 'nodejs')
+        ),
+        verify=('node', '--version'),
+        post_install=('npm', 'install', '-g', 'npm@latest')
+    ),
+    'python': Template(
+        name='Python',
+        commands=(
+            ('sudo', 'apt', 'update'),
+            ('sudo', 'apt', 'install', '-y', 'python3', 'python3-pip', 'python3-venv')
+        ),
+        verify=('python3', '--version'),
+        post_install=('pip3', 'install', '--upgrade', 'pip')
+    ),
+    'java': Template(
+        name='Java',
+        commands=(
+            ('sudo', 'apt', 'update'),
+            ('sudo', 'apt', 'install', '-y', 'default-jdk')
+        ),
+        # No post_install: 'update-alternatives --config' is interactive
+        verify=('java', '-version')
+    ),
+    'git': Template(
+        name='Git',
+        commands=(
+            ('sudo', 'apt', 'update'),
+            ('sudo', 'apt', 'install', '-y', 'git')
+        ),
+        verify=('git', '--version'),
+        post_install=('git', 'config', '--global', 'init.defaultBranch', 'main')
+    )
+})
+
+
+def _as_template(spec) -> Template:
+    """Normalize a configured template override into a hashable Template"""
+    if isinstance(spec, Template):
+        return spec
+    
+    return Template(
+        name=spec['name'],
+        commands=tuple(
+            Download(**step) if isinstance(step, dict) else tuple(step)
+            for step in spec['commands']
+        ),
+        verify=tuple(spec['verify']),
+        post_install=tuple(spec['post_install']) if spec.get('post_install') else None,
+        depends_on=tuple(tuple(deps) for deps in spec['depends_on']) if spec.get('depends_on') else None
+    )
+
+
+def _read_dpkg_status(path: str) -> frozenset:
+    """Collect installed package names straight from dpkg's status file (runs in a worker thread)"""
+    installed = set()
+    name = None
+    
+    with open(path, 'rb') as f:
+        for line in f:
+            if line.startswith(b'Package: '):
+                name = sys.intern(line[9:].strip().decode())
+            elif line.startswith(b'Status: ') and name is not None:
+                # Same criterion as the dpkg-query path in parse_batch_check_output
+                if line[8:].strip() == b'install ok installed':
+                    installed.add(name)
+            elif line == b'\n':
+                name = None
+    
+    return frozenset(installed)
+
+
+def _read_pacman_local(path: str) -> frozenset:
+    """Collect installed package names from pacman's local database directory (runs in a worker thread)"""
+    # Each installed package has a <name>-<pkgver>-<pkgrel> directory; names may contain hyphens
+    with os.scandir(path) as entries:
+        return frozenset(
+            sys.intern(entry.name.rsplit('-', 2)[0])
+            for entry in entries
+            if entry.is_dir() and entry.name.count('-') >= 2
+        )
+
+
+# Managers whose installed set can be read from disk without spawning the manager
+_PACKAGE_DB_READERS = {
+    'apt': _read_dpkg_status,
+    'pacman': _read_pacman_local
+}
+
+
+@functools.lru_cache(maxsize=None)
+def _template_levels(template: Template) -> Tuple[Tuple[Any, ...], ...]:
+    """Topologically group a template's steps into levels that can run concurrently
+    
+    Each level is the ready set of a graphlib.TopologicalSorter, with its
+    install steps already merged. Templates are immutable, so the plan is
+    computed once per template; $VARS are left for _expand_step at run time.
+    """
+    commands = template.commands
+    depends_on = template.depends_on or [[i - 1] if i else [] for i in range(len(commands))]
+    
+    sorter = graphlib.TopologicalSorter()
+    for i, deps in enumerate(depends_on):
+        sorter.add(i, *deps)
+    sorter.prepare()
+    
+    levels = []
+    while sorter.is_active():
+        ready = sorted(sorter.get_ready())
+        merged = _merge_install_steps([commands[i] for i in ready])
+        levels.append(tuple(step if isinstance(step, Download) else tuple(step) for step in merged))
+        sorter.done(*ready)
+    
+    return tuple(levels)
+
+
+def _expand_step(step):
+    """Expand $VARS in an argv step against the current environment"""
+    if isinstance(step, Download):
+        return step
+    return tuple(os.path.expandvars(arg) for arg in step)
+
+
+def _unset_var(step) -> Optional[str]:
+    """Return the first $VAR that expansion left in an argv step, if any"""
+    if isinstance(step, Download):
+        return None
+    for arg in step:
+        match = _UNSET_VAR_RE.search(arg)
+        if match:
+            return match.group(0)
+    return None
+
+
+@functools.lru_cache(maxsize=4)
+def _detect_package_managers(path_env: str) -> Dict[str, bool]:
+    """Scan the given PATH for the known package managers, once per distinct PATH"""
+    candidates = set(PackageManager.MANAGERS)
+    found = set()
+    
+    # One listing per PATH directory instead of one lookup per (directory, manager)
+    for directory in path_env.split(os.pathsep):
+        try:
+            with os.scandir(directory or os.curdir) as entries:
+                names = {entry.name for entry in entries}
+        except OSError:
+            continue
+        
+        for name in candidates & names - found:
+            if os.access(os.path.join(directory, name), os.X_OK):
+                found.add(name)
+        if found == candidates:
+            break
+    
+    return {manager: manager in found for manager in PackageManager.MANAGERS}
 
 
 class SoftwareInstallAgent(BaseAgent):
     """Enhanced agent for handling software installations and updates"""
     
-    def __init__(self, hardware_info: Dict, security_manager, logger):
+    # Keyword found in an LLM plan -> rule keyword of its handler, in priority order
+    _LLM_DISPATCH = {
+        'docker': 'docker',
+        'node': 'nodejs',
+        'python': 'python',
+        'java': 'java',
+        'git': 'git'
+    }
+    
+    # Rule keyword -> handler method name, in match priority order
+    _RULE_NAMES = (
+        ('install', '_rule_install_software'),
+        ('remove', '_rule_remove_software'),
+        ('update', '_rule_update_software'),
+        ('upgrade', '_rule_upgrade_system'),
+        ('search', '_rule_search_software'),
+        ('list', '_rule_list_installed'),
+        ('verify', '_rule_verify_installation'),
+        ('rollback', '_rule_rollback_installation')
+    )
+    
+    def __init__(self, hardware_info: Dict, security_manager, logger, confirm_cb=None):
         super().__init__("software_install_agent", hardware_info, security_manager, logger)
         self.name = "Software Installation Agent"
         self.description = "Handles software installations, updates, and dependency resolution with async processing"
@@ -100,63 +469,75 @@ class SoftwareInstallAgent(BaseAgent):
             "retry_failed_installs": 3,
             "check_dependencies": True,
             "safe_mode": True,
-            "dry_run": False
+            "dry_run": False,
+            "max_concurrent_subprocesses": min(8, os.cpu_count() or 4),
+            "installed_cache_ttl": 60,  # seconds
+            "metadata_ttl": 600,  # skip the pre-install update if lists are newer than this
+            "probe_cache_ttl": 30,  # seconds idempotent probe results are reused
+            "probe_cache_size": 128,
+            "history_size": 1000,  # completed installations kept in memory
+            "output_tail_bytes": 65536,  # output kept from install/update steps
+            "installed_cache_path": Path.home() / ".cache" / "ai_orchestrator" / "installed.json"
         }
         
+        # Caps concurrent subprocesses; created lazily inside the running event loop
+        self._subprocess_semaphore = None
+        
+        # One lock per package database so sudo'd manager calls never race for it
+        self._mgr_locks = {}
+        
+        # Async confirmation prompt; the default reads stdin on a worker thread
+        # so concurrent tasks keep running while waiting for the user
+        self._confirm = confirm_cb or (
+            lambda prompt: asyncio.get_running_loop().run_in_executor(None, input, prompt)
+        )
+        
+        # Shared HTTP session for template downloads; created lazily inside the event loop
+        self._http = None
+        
+        # (argv, PATH) of an idempotent probe -> (monotonic timestamp, result)
+        self._probe_cache = {}
+        
+        # Template key -> {version, installed_at, verify_cmd}, persisted across runs
+        self._known_installs = None
+        
+        # Installed package names, valid while the package database mtime is unchanged
+        # (or for installed_cache_ttl when the database can't be stat'ed)
+        self._installed_cache = None
+        self._installed_cache_key = None
+        self._installed_cache_ts = 0
+        
+        # When package metadata was last known to be refreshed
+        self._last_update_ts = 0
+        
         # Installation tracking
         self.active_installations = {}
-        self.installation_history = []
+        self.installation_history = deque(maxlen=self.config['history_size'])
         self.rollback_points = {}
         
         # Package manager detection
         self.package_managers = PackageManager.detect_package_manager()
-        self.primary_manager, self.primary_cmd = PackageManager.get_primary_manager()
+        self.primary_manager, self.primary_cmd = PackageManager.get_primary_manager(self.package_managers)
         
-        # Installation templates for common software
-        self.install_templates = {
-            'docker': {
-                'commands': [
-                    'curl -fsSL https://get.docker.com -o get-docker.sh',
-                    'sudo sh get-docker.sh',
-                    'sudo usermod -aG docker $USER'
-                ],
-                'verify': 'docker --version',
-                'post_install': 'sudo systemctl enable docker'
-            },
-            'nodejs': {
-                'commands': [
-                    'curl -fsSL https://deb.nodesource.com/setup_lts.x | sudo -E bash -',
-                    'sudo apt-get install -y nodejs'
-                ],
-                'verify': 'node --version',
-                'post_install': 'npm install -g npm@latest'
-            },
-            'python': {
-                'commands': [
-                    'sudo apt update',
-                    'sudo apt install -y python3 python3-pip python3-venv'
-                ],
-                'verify': 'python3 --version',
-                'post_install': 'pip3 install --upgrade pip'
-            },
-            'java': {
-                'commands': [
-                    'sudo apt update',
-                    'sudo apt install -y default-jdk'
-                ],
-                'verify': 'java -version',
-                'post_install': 'sudo update-alternatives --config java'
-            },
-            'git': {
-                'commands': [
-                    'sudo apt update',
-                    'sudo apt install -y git'
-                ],
-                'verify': 'git --version',
-                'post_install': 'git config --global init.defaultBranch main'
-            }
+        # Ready-to-run argv prefix per action, with sudo already applied where needed
+        self._argv = {
+            action: ('sudo', *argv) if action in ('install', 'remove', 'update', 'upgrade') else argv
+            for action, argv in self.primary_cmd.items()
         }
         
+        # Installation templates for common software
+        # Shared templates, with per-agent overrides merged only when configured
+        overrides = hardware_info.get('config', {}).get('template_overrides')
+        if overrides:
+            self.install_templates = MappingProxyType({
+                **INSTALL_TEMPLATES,
+                **{key: _as_template(spec) for key, spec in overrides.items()}
+            })
+            # Rule patterns were built by BaseAgent before the merge; rebuild so added templates dispatch
+            self.rule_patterns = self._initialize_rule_patterns()
+        else:
+            self.install_templates = INSTALL_TEMPLATES
+        
         # Statistics tracking
         self.stats = {
             'packages_installed': 0,
@@ -167,29 +548,48 @@ class SoftwareInstallAgent(BaseAgent):
             'rollbacks_performed': 0
         }
         
+        # The parts of get_stats() that never change after init
+        self._stats_base = {
+            'agent': self.name,
+            'config': self.config,
+            'package_manager': self.primary_manager,
+            'available_managers': self.package_managers,
+            'install_templates': tuple(self.install_templates)
+        }
+        
         self.logger.info(f"Enhanced Software Installation Agent initialized with {self.primary_manager}")
     
     def _initialize_rule_patterns(self) -> Dict[str, callable]:
         """Initialize rule-based patterns for software installation"""
-        return {
-            'install': self._rule_install_software,
-            'remove': self._rule_remove_software,
-            'update': self._rule_update_software,
-            'upgrade': self._rule_upgrade_system,
-            'search': self._rule_search_software,
-            'list': self._rule_list_installed,
-            'verify': self._rule_verify_installation,
-            'rollback': self._rule_rollback_installation,
-            'docker': self._rule_install_docker,
-            'nodejs': self._rule_install_nodejs,
-            'python': self._rule_install_python,
-            'java': self._rule_install_java,
-            'git': self._rule_install_git
-        }
+        patterns = {keyword: getattr(self, name) for keyword, name in self._RULE_NAMES}
+        # Each install template is reachable by its own key; BaseAgent calls this before
+        # __init__ has merged any overrides, so fall back to the shared templates
+        for key in getattr(self, 'install_templates', INSTALL_TEMPLATES):
+            patterns[key] = functools.partial(self._install_from_template, key)
+        
+        # One automaton pass finds every keyword; values carry rule priority (dict order)
+        self._rule_automaton = None
+        if AHOCORASICK_AVAILABLE:
+            self._rule_automaton = ahocorasick.Automaton()
+            for priority, keyword in enumerate(patterns):
+                self._rule_automaton.add_word(keyword, (priority, keyword))
+            self._rule_automaton.make_automaton()
+        
+        return patterns
+    
+    def match_rule_pattern(self, input_text: str) -> Optional[Callable]:
+        """Match input against rule patterns, keeping the first-listed rule on ties"""
+        if self._rule_automaton is None:
+            return super().match_rule_pattern(input_text)
+        
+        matches = [value for _, value in self._rule_automaton.iter(input_text.lower())]
+        if not matches:
+            return None
+        return self.rule_patterns[min(matches)[1]]
     
     async def _process_task_with_llm(self, task) -> Dict:
         """Process software installation task using LLM with safety checks"""
-            context = {
+        context = {
             'package_manager': self.primary_manager,
             'available_managers': self.package_managers,
             'install_templates': list(self.install_templates.keys()),
@@ -222,7 +622,7 @@ Be specific about commands and safety measures. Only suggest safe operations.
         if response:
             # Parse LLM response and execute safely
             return await self._execute_llm_plan(response, task)
-            else:
+        else:
             # Fallback to rules
             return await self._process_task_with_rules(task)
     
@@ -232,13 +632,13 @@ Be specific about commands and safety measures. Only suggest safe operations.
             # Yield control for other tasks
             await asyncio.sleep(0)
             
-            # Check if package already exists first (efficiency improvement)
+            # Check if packages already exist first (efficiency improvement)
             if 'install' in task.command.lower():
-                package_name = self._extract_package_name(task.command)
-                if package_name and await self._is_package_installed(package_name):
+                package_names = self._extract_package_names(task.command)
+                if package_names and all((await self._are_packages_installed(package_names)).values()):
                     return {
                         'success': True,
-                        'result': f"{package_name} is already installed",
+                        'result': f"{', '.join(package_names)} already installed",
                         'method': 'rules'
                     }
             
@@ -248,22 +648,17 @@ Be specific about commands and safety measures. Only suggest safe operations.
             if handler:
                 # Execute with safety checks
                 if self._requires_confirmation(task.command):
-                    confirm = input(f"Confirm software operation: {task.command}? (y/n): ")
+                    confirm = await self._confirm(f"Confirm software operation: {task.command}? (y/n): ")
                     if confirm.lower() != 'y':
-            return {
-                'success': False,
+                        return {
+                            'success': False,
                             'result': 'Operation cancelled by user',
                             'method': 'rules'
                         }
-        
-                result = await handler(task.command)
+                
+                return self._handler_response(await handler(task.command), 'rules')
+            else:
                 return {
-                    'success': True,
-                    'result': result,
-                    'method': 'rules'
-                }
-        else:
-        return {
                     'success': False,
                     'error': 'No matching rule pattern found',
                     'method': 'rules'
@@ -290,55 +685,234 @@ Be specific about commands and safety measures. Only suggest safe operations.
     
     def _requires_confirmation(self, command: str) -> bool:
         """Check if command requires user confirmation"""
-        dangerous_keywords = ['remove', 'uninstall', 'purge', 'upgrade', 'dist-upgrade']
-        return any(keyword in command.lower() for keyword in dangerous_keywords)
+        return _DANGEROUS_RE.search(command) is not None
     
     def _extract_package_name(self, command: str) -> Optional[str]:
         """Extract package name from command"""
         # Simple pattern matching - would need more sophisticated parsing
-        import re
-        
-        patterns = [
-            r'install\s+([^\s]+)',
-            r'remove\s+([^\s]+)',
-            r'search\s+([^\s]+)',
-            r'verify\s+([^\s]+)'
-        ]
-        
-        for pattern in patterns:
-            match = re.search(pattern, command, re.IGNORECASE)
+        for pattern in _PKG_PATTERNS:
+            match = pattern.search(command)
             if match:
                 return match.group(1)
         
         return None
     
-    async def _is_package_installed(self, package_name: str) -> bool:
-        """Check if package is already installed"""
+    def _extract_package_names(self, command: str) -> List[str]:
+        """Extract all package names from an install/remove command"""
+        match = _PKG_LIST_RE.search(command)
+        if not match:
+            return []
+        
+        # Stop at the first preposition and keep only tokens shaped like package names,
+        # since every name ends up in one manager invocation
+        names = []
+        for token in _PKG_SPLIT_RE.split(match.group(1).strip().rstrip('.!?')):
+            word = token.lower()
+            if word in _PKG_LIST_STOPWORDS:
+                break
+            if word in _PKG_LIST_FILLER or not _PKG_NAME_RE.match(token):
+                continue
+            names.append(token)
+        
+        return names
+    
+    def _metadata_fresh(self) -> bool:
+        """Check whether package metadata was refreshed within metadata_ttl"""
+        ttl = self.config['metadata_ttl']
+        now = time.time()
+        if now - self._last_update_ts < ttl:
+            return True
+        
+        # apt touches its lists directory on every update, even ones run outside this agent
+        if self.primary_manager == 'apt':
+            try:
+                self._last_update_ts = os.stat('/var/lib/apt/lists').st_mtime
+            except OSError:
+                return False
+            return now - self._last_update_ts < ttl
+        
+        return False
+    
+    def _package_db_key(self) -> Optional[int]:
+        """mtime of the primary manager's package database, or None if unavailable"""
+        for path in _PACKAGE_DB_PATHS.get(self.primary_manager, ()):
+            try:
+                return os.stat(path).st_mtime_ns
+            except OSError:
+                continue
+        
+        return None
+    
+    async def _installed_set(self) -> frozenset:
+        """Return the cached set of installed packages, refreshing it once stale"""
+        now = time.monotonic()
+        db_key = self._package_db_key()
+        if self._installed_cache is None:
+            stale = True
+        elif db_key is not None:
+            stale = db_key != self._installed_cache_key
+        else:
+            stale = now - self._installed_cache_ts > self.config['installed_cache_ttl']
+        
+        if stale:
+            self._installed_cache = await self._list_installed()
+            self._installed_cache_key = db_key
+            self._installed_cache_ts = now
+        
+        return self._installed_cache
+    
+    async def _list_installed(self) -> frozenset:
+        """List every installed package, reading the manager's database directly when possible"""
+        reader = _PACKAGE_DB_READERS.get(self.primary_manager)
+        if reader is not None:
+            loop = asyncio.get_running_loop()
+            try:
+                return await loop.run_in_executor(None, reader, _PACKAGE_DB_PATHS[self.primary_manager][0])
+            except OSError:
+                pass  # Fall back to the manager's own query command
+        
         try:
-            check_cmd = self.primary_cmd['check']
-            result = await self._run_command(f"{check_cmd} {package_name}")
-            return result['returncode'] == 0
+            result = await self._run_command(list(self._argv['installed']), timeout=60)
+            return frozenset(
+                sys.intern(name)
+                for name in PackageManager.parse_batch_check_output(self.primary_manager, result['stdout'])
+            )
         except Exception:
-            return False
+            return frozenset()
+    
+    def _update_installed_set(self, added=(), removed=()):
+        """Apply our own install/remove to the cached set and adopt the new database mtime
+        
+        This skips the full re-list the mtime change would otherwise trigger. With
+        nothing cached yet, the next _installed_set call lists the database as usual.
+        """
+        if self._installed_cache is None:
+            return
+        
+        self._installed_cache = self._installed_cache.union(added).difference(removed)
+        self._installed_cache_key = self._package_db_key()
+        self._installed_cache_ts = time.monotonic()
     
-    async def _run_command(self, command: str, timeout: int = 30) -> Dict:
-        """Run command asynchronously with timeout"""
+    async def _query_installed(self, package_names: List[str]) -> set:
+        """Ask the package manager directly which of the given packages are installed"""
         try:
-            process = await asyncio.create_subprocess_shell(
-                command,
-                stdout=asyncio.subprocess.PIPE,
-                stderr=asyncio.subprocess.PIPE
-            )
+            query_cmd = PackageManager.get_batch_check_command(self.primary_manager, package_names)
+            result = await self._run_command(query_cmd)
+            return PackageManager.parse_batch_check_output(self.primary_manager, result['stdout'])
+        except Exception:
+            return set()
+    
+    async def _are_packages_installed(self, package_names: List[str]) -> Dict[str, bool]:
+        """Check the install state of several packages against the cached set"""
+        installed = await self._installed_set()
+        return {name: name in installed for name in package_names}
+    
+    async def _install_packages(self, package_names: List[str]) -> Dict:
+        """Install all packages with a single package-manager invocation"""
+        install_cmd = [*self._argv['install'], *package_names]
+        return await self._run_command(
+            install_cmd,
+            timeout=self.config['max_install_time'],
+            tail_bytes=self.config['output_tail_bytes']
+        )
+    
+    async def _is_package_installed(self, package_name: str) -> bool:
+        """Check if package is already installed"""
+        return (await self._are_packages_installed([package_name]))[package_name]
+    
+    async def _run_command(self, argv: List[str], timeout: int = 30, max_lines: Optional[int] = None,
+                           tail_bytes: Optional[int] = None, idempotent: bool = False,
+                           capture_output: bool = True) -> Dict:
+        """Run an argv command asynchronously (no shell) with timeout
+        
+        With max_lines set, stdout is streamed and the process is terminated
+        once that many lines have been read. With tail_bytes set, output is
+        drained as it arrives and only the last tail_bytes of each stream kept.
+        Idempotent probes reuse their result for probe_cache_ttl seconds.
+        Without capture_output, both streams go to /dev/null and only the
+        return code is reported.
+        """
+        if idempotent:
+            key = self._probe_key(argv)
+            cached = self._probe_cache.get(key)
+            if cached and time.monotonic() - cached[0] < self.config['probe_cache_ttl']:
+                return cached[1]
             
-            stdout, stderr = await asyncio.wait_for(
-                process.communicate(), 
-                timeout=timeout
-            )
+            result = await self._run_command(argv, timeout, max_lines, tail_bytes, capture_output=capture_output)
+            self._store_probe(key, result)
+            return result
+        
+        if self._subprocess_semaphore is None:
+            self._subprocess_semaphore = asyncio.Semaphore(self.config['max_concurrent_subprocesses'])
+        
+        # Mutating manager calls (always run through sudo) serialize on their database lock
+        lock_group = _MANAGER_LOCK_GROUPS.get(argv[1]) if argv[0] == 'sudo' and len(argv) > 1 else None
+        if lock_group is not None:
+            if lock_group not in self._mgr_locks:
+                self._mgr_locks[lock_group] = asyncio.Lock()
+            async with self._mgr_locks[lock_group]:
+                return await self._exec_command(argv, timeout, max_lines, tail_bytes, capture_output)
+        
+        return await self._exec_command(argv, timeout, max_lines, tail_bytes, capture_output)
+    
+    @staticmethod
+    def _probe_key(argv: List[str]) -> Tuple:
+        """Cache key for a probe; PATH decides which binary actually runs"""
+        return tuple(argv), os.environ.get('PATH', '')
+    
+    def _store_probe(self, key: Tuple, result: Dict):
+        """Remember a probe result, evicting the oldest entry when full"""
+        self._probe_cache.pop(key, None)
+        self._probe_cache[key] = (time.monotonic(), result)
+        if len(self._probe_cache) > self.config['probe_cache_size']:
+            del self._probe_cache[next(iter(self._probe_cache))]
+    
+    async def _exec_command(self, argv: List[str], timeout: int, max_lines: Optional[int],
+                            tail_bytes: Optional[int], capture_output: bool = True) -> Dict:
+        """Spawn argv under the subprocess cap and collect its output"""
+        stream = asyncio.subprocess.PIPE if capture_output else asyncio.subprocess.DEVNULL
+        try:
+            async with self._subprocess_semaphore:
+                # Head reads stop early, so give them their own process group to signal as a whole
+                process = await asyncio.create_subprocess_exec(
+                    *argv,
+                    stdout=stream,
+                    stderr=stream,
+                    start_new_session=max_lines is not None
+                )
+                
+                if not capture_output:
+                    try:
+                        returncode = await asyncio.wait_for(process.wait(), timeout=timeout)
+                    except asyncio.TimeoutError:
+                        # Don't leave the child running behind a timed-out call
+                        process.kill()
+                        await process.wait()
+                        raise
+                    return {'returncode': returncode, 'stdout': '', 'stderr': ''}
+                
+                if max_lines is not None:
+                    stdout, stderr, returncode = await asyncio.wait_for(
+                        self._read_head(process, max_lines),
+                        timeout=timeout
+                    )
+                elif tail_bytes is not None:
+                    stdout, stderr, returncode = await asyncio.wait_for(
+                        self._read_tail(process, tail_bytes),
+                        timeout=timeout
+                    )
+                else:
+                    stdout, stderr = await asyncio.wait_for(
+                        process.communicate(), 
+                        timeout=timeout
+                    )
+                    returncode = process.returncode
             
+            # A tail can start mid-character, so don't let decoding fail the command
             return {
-                'returncode': process.returncode,
-                'stdout': stdout.decode(),
-                'stderr': stderr.decode()
+                'returncode': returncode,
+                'stdout': stdout.decode(errors='replace'),
+                'stderr': stderr.decode(errors='replace')
             }
             
         except asyncio.TimeoutError:
@@ -354,22 +928,81 @@ Be specific about commands and safety measures. Only suggest safe operations.
                 'stderr': str(e)
             }
     
+    async def _read_head(self, process, max_lines: int) -> Tuple[bytes, bytes, int]:
+        """Read up to max_lines of stdout, stopping the process group early once the cap is hit"""
+        stderr_task = asyncio.ensure_future(process.stderr.read())
+        
+        lines = []
+        try:
+            async for line in process.stdout:
+                lines.append(line)
+                if len(lines) == max_lines:
+                    break
+            
+            # Exactly max_lines of output is not truncation: only cut the command
+            # short if more is coming, otherwise report its real exit code
+            if len(lines) == max_lines and await process.stdout.read(1):
+                # Grandchildren can hold the pipes open, so signal the whole group
+                # and stop draining stderr rather than wait for its EOF
+                self._signal_group(process, signal.SIGTERM)
+                stderr_task.cancel()
+                await process.wait()
+                return b''.join(lines), b'', 0
+            
+            stderr = await stderr_task
+            await process.wait()
+        except asyncio.CancelledError:
+            # Timed out: don't leave the children or the stderr reader behind
+            stderr_task.cancel()
+            self._signal_group(process, signal.SIGKILL)
+            await process.wait()
+            raise
+        
+        return b''.join(lines), stderr, process.returncode
+    
+    @staticmethod
+    def _signal_group(process, sig: int):
+        """Signal a process started with start_new_session and everything it spawned"""
+        try:
+            os.killpg(process.pid, sig)
+        except ProcessLookupError:
+            pass
+    
+    async def _read_tail(self, process, tail_bytes: int) -> Tuple[bytes, bytes, int]:
+        """Drain stdout and stderr concurrently, keeping only the last tail_bytes of each"""
+        async def tail(stream) -> bytes:
+            buf = bytearray()
+            while True:
+                chunk = await stream.read(65536)
+                if not chunk:
+                    return bytes(buf)
+                buf += chunk
+                if len(buf) > tail_bytes:
+                    del buf[:-tail_bytes]
+        
+        try:
+            stdout, stderr = await asyncio.gather(tail(process.stdout), tail(process.stderr))
+        except asyncio.CancelledError:
+            # Timed out: don't leave the child behind
+            process.kill()
+            raise
+        
+        await process.wait()
+        return stdout, stderr, process.returncode
+    
     async def _execute_llm_plan(self, llm_response: str, task) -> Dict:
         """Execute LLM-generated installation plan with safety checks"""
         try:
             # Parse LLM response (simplified - would need more sophisticated parsing)
-            if 'docker' in llm_response.lower():
-                return await self._rule_install_docker(task.command)
-            elif 'nodejs' in llm_response.lower() or 'node' in llm_response.lower():
-                return await self._rule_install_nodejs(task.command)
-            elif 'python' in llm_response.lower():
-                return await self._rule_install_python(task.command)
-            elif 'java' in llm_response.lower():
-                return await self._rule_install_java(task.command)
-            elif 'install' in llm_response.lower():
-                return await self._rule_install_software(task.command)
+            # Priority decides between mentioned tools, not their position in the text
+            found = {match.group(0).lower() for match in _LLM_RE.finditer(llm_response)}
+            keyword = next((keyword for keyword in self._LLM_DISPATCH if keyword in found), None)
+            if keyword:
+                handler = self.rule_patterns[self._LLM_DISPATCH[keyword]]
             else:
-                return await self._rule_install_software(task.command)  # Default
+                handler = self._rule_install_software  # Default
+            
+            return self._handler_response(await handler(task.command), 'llm')
                 
         except Exception as e:
             self.logger.error(f"LLM plan execution failed: {e}")
@@ -379,80 +1012,175 @@ Be specific about commands and safety measures. Only suggest safe operations.
                 'method': 'llm'
             }
     
+    @staticmethod
+    def _handler_response(result, method: str) -> Dict:
+        """Wrap a rule handler's return value in the task response format"""
+        if isinstance(result, InstallResult):
+            return {'success': result.ok, 'result': result.message, 'method': method}
+        return {'success': True, 'result': result, 'method': method}
+    
+    async def _download(self, url: str, dest: str, timeout: int = 300) -> Dict:
+        """Download url to dest over the shared HTTP session, falling back to curl"""
+        if not AIOHTTP_AVAILABLE:
+            return await self._run_command(
+                ['curl', '-fsSL', url, '-o', dest], timeout=timeout, tail_bytes=self.config['output_tail_bytes']
+            )
+        
+        if self._http is None or self._http.closed:
+            self._http = aiohttp.ClientSession()
+        
+        try:
+            async with self._http.get(url, timeout=aiohttp.ClientTimeout(total=timeout)) as response:
+                response.raise_for_status()
+                with open(dest, 'wb') as f:
+                    async for chunk in response.content.iter_chunked(65536):
+                        f.write(chunk)
+            
+            return {'returncode': 0, 'stdout': '', 'stderr': ''}
+        
+        except Exception as e:
+            return {'returncode': -1, 'stdout': '', 'stderr': str(e)}
+    
+    def _run_step(self, step, timeout: int = 300):
+        """Start one template step: an argv or a Download"""
+        if isinstance(step, Download):
+            return self._download(step.url, step.dest, timeout=timeout)
+        return self._run_command(step, timeout=timeout, tail_bytes=self.config['output_tail_bytes'])
+    
+    @staticmethod
+    def _step_label(step) -> str:
+        """Human-readable form of a template step for progress output"""
+        if isinstance(step, Download):
+            return f"download {step.url} -> {step.dest}"
+        return shlex.join(step)
+    
+    async def _run_template_steps(self, template: Template) -> Tuple[List[str], Optional[Tuple[str, Dict]]]:
+        """Run template commands level by level, returning progress lines and the first failure"""
+        results = []
+        dry_run = self.config['dry_run']
+        step_label = self._step_label
+        
+        for level in _template_levels(template):
+            # Expand per run so the steps follow the current environment, and refuse to
+            # pass an unset variable through literally (the shell used to expand these)
+            level = [_expand_step(step) for step in level]
+            for step in level:
+                unset = _unset_var(step)
+                if unset:
+                    return results, (step_label(step), {
+                        'returncode': -1,
+                        'stdout': '',
+                        'stderr': f"Environment variable {unset} is not set"
+                    })
+            
+            # Drop metadata refreshes while the last one is still warm
+            if self._metadata_fresh():
+                warm = [step for step in level if tuple(step) in _UPDATE_COMMANDS]
+                if warm:
+                    results.extend("✓ cached update: " + step_label(step) for step in warm)
+                    level = [step for step in level if tuple(step) not in _UPDATE_COMMANDS]
+            
+            if dry_run:
+                results.extend("Dry run: " + step_label(step) for step in level)
+                continue
+            
+            level_results = await asyncio.gather(*(self._run_step(step) for step in level))
+            for step, result in zip(level, level_results):
+                label = step_label(step)
+                if result['returncode'] != 0:
+                    return results, (label, result)
+                if tuple(step) in _UPDATE_COMMANDS:
+                    self._last_update_ts = time.time()
+                results.append("✓ " + label)
+        
+        return results, None
+    
     # Rule-based handlers with async processing
-    async def _rule_install_software(self, command: str) -> str:
-        """Install software package with async processing"""
+    async def _rule_install_software(self, command: str) -> InstallResult:
+        """Install software packages with a single package-manager invocation"""
         try:
-            package_name = self._extract_package_name(command)
-            if not package_name:
-                return "Could not extract package name from command"
+            package_names = self._extract_package_names(command)
+            if not package_names:
+                return InstallResult(False, "Could not extract package name from command")
             
-            # Check if already installed
-            if await self._is_package_installed(package_name):
-                return f"{package_name} is already installed"
+            # Skip packages that are already installed
+            installed = await self._are_packages_installed(package_names)
+            packages = [name for name in package_names if not installed[name]]
+            if not packages:
+                return InstallResult(True, f"{', '.join(package_names)} already installed")
             
-            start_time = time.time()
+            package_list = ' '.join(packages)
+            start_time = time.monotonic()
             
             # Update package lists if configured
-            if self.config['auto_update_before_install']:
+            if self.config['auto_update_before_install'] and not self._metadata_fresh():
                 update_result = await self._run_command(
-                    f"sudo {self.primary_cmd['update']}", 
-                    timeout=300
+                    list(self._argv['update']), 
+                    timeout=300,
+                    tail_bytes=self.config['output_tail_bytes']
                 )
                 if update_result['returncode'] != 0:
-                    return f"Failed to update package lists: {update_result['stderr']}"
-            
-            # Install package
-            install_cmd = f"sudo {self.primary_cmd['install']} {package_name}"
+                    return InstallResult(False, f"Failed to update package lists: {update_result['stderr']}")
+                self._last_update_ts = time.time()
             
             if not self.config['dry_run']:
-                result = await self._run_command(install_cmd, timeout=self.config['max_install_time'])
+                result = await self._install_packages(packages)
                 
                 if result['returncode'] == 0:
-                    # Verify installation
-                    if await self._is_package_installed(package_name):
-                        install_time = time.time() - start_time
-                        self.stats['packages_installed'] += 1
+                    # Verify installation and record the new packages in the cache
+                    verified = await self._query_installed(packages)
+                    self._update_installed_set(added=verified)
+                    failed = [name for name in packages if name not in verified]
+                    
+                    if not failed:
+                        install_time = time.monotonic() - start_time
+                        self.stats['packages_installed'] += len(packages)
                         self.stats['total_install_time'] += install_time
                         
-                        return f"Successfully installed {package_name} in {install_time:.1f}s"
-        else:
-                        self.stats['failed_installations'] += 1
-                        return f"Installation completed but {package_name} verification failed"
+                        return InstallResult(True, f"Successfully installed {package_list} in {install_time:.1f}s")
+                    else:
+                        self.stats['failed_installations'] += len(failed)
+                        return InstallResult(False, f"Installation completed but {' '.join(failed)} verification failed")
                 else:
-                    self.stats['failed_installations'] += 1
-                    return f"Failed to install {package_name}: {result['stderr']}"
+                    self.stats['failed_installations'] += len(packages)
+                    return InstallResult(False, f"Failed to install {package_list}: {result['stderr']}")
             else:
-                return f"Dry run: Would install {package_name}"
+                return InstallResult(True, f"Dry run: Would install {package_list}")
             
         except Exception as e:
             self.stats['failed_installations'] += 1
-            return f"Installation error: {str(e)}"
+            return InstallResult(False, f"Installation error: {str(e)}")
     
     async def _rule_remove_software(self, command: str) -> str:
-        """Remove software package with async processing"""
+        """Remove software packages with a single package-manager invocation"""
         try:
-            package_name = self._extract_package_name(command)
-            if not package_name:
+            package_names = self._extract_package_names(command)
+            if not package_names:
                 return "Could not extract package name from command"
             
             # Check if installed
-            if not await self._is_package_installed(package_name):
-                return f"{package_name} is not installed"
+            installed = await self._are_packages_installed(package_names)
+            packages = [name for name in package_names if installed[name]]
+            if not packages:
+                return f"{', '.join(package_names)} not installed"
+            
+            package_list = ' '.join(packages)
             
-            # Remove package
-            remove_cmd = f"sudo {self.primary_cmd['remove']} {package_name}"
+            # Remove packages
+            remove_cmd = [*self._argv['remove'], *packages]
             
             if not self.config['dry_run']:
-                result = await self._run_command(remove_cmd, timeout=300)
+                result = await self._run_command(remove_cmd, timeout=300, tail_bytes=self.config['output_tail_bytes'])
                 
                 if result['returncode'] == 0:
-                    self.stats['packages_removed'] += 1
-                    return f"Successfully removed {package_name}"
-            else:
-                    return f"Failed to remove {package_name}: {result['stderr']}"
+                    self._update_installed_set(removed=packages)
+                    await self._forget_installs()
+                    self.stats['packages_removed'] += len(packages)
+                    return f"Successfully removed {package_list}"
+                else:
+                    return f"Failed to remove {package_list}: {result['stderr']}"
             else:
-                return f"Dry run: Would remove {package_name}"
+                return f"Dry run: Would remove {package_list}"
             
         except Exception as e:
             return f"Removal error: {str(e)}"
@@ -460,14 +1188,15 @@ Be specific about commands and safety measures. Only suggest safe operations.
     async def _rule_update_software(self, command: str) -> str:
         """Update package lists with async processing"""
         try:
-            update_cmd = f"sudo {self.primary_cmd['update']}"
+            update_cmd = list(self._argv['update'])
             
             if not self.config['dry_run']:
-                result = await self._run_command(update_cmd, timeout=300)
+                result = await self._run_command(update_cmd, timeout=300, tail_bytes=self.config['output_tail_bytes'])
                 
                 if result['returncode'] == 0:
+                    self._last_update_ts = time.time()
                     return "Successfully updated package lists"
-            else:
+                else:
                     return f"Failed to update package lists: {result['stderr']}"
             else:
                 return "Dry run: Would update package lists"
@@ -478,12 +1207,17 @@ Be specific about commands and safety measures. Only suggest safe operations.
     async def _rule_upgrade_system(self, command: str) -> str:
         """Upgrade system packages with async processing"""
         try:
-            upgrade_cmd = f"sudo {self.primary_cmd['upgrade']}"
+            upgrade_cmd = list(self._argv['upgrade'])
             
             if not self.config['dry_run']:
-                result = await self._run_command(upgrade_cmd, timeout=1800)  # 30 minutes
+                result = await self._run_command(
+                    upgrade_cmd,
+                    timeout=1800,  # 30 minutes
+                    tail_bytes=self.config['output_tail_bytes']
+                )
                 
                 if result['returncode'] == 0:
+                    await self._forget_installs()
                     self.stats['packages_updated'] += 1
                     return "Successfully upgraded system packages"
                 else:
@@ -501,13 +1235,12 @@ Be specific about commands and safety measures. Only suggest safe operations.
             if not search_term:
                 return "Could not extract search term from command"
             
-            search_cmd = f"{self.primary_cmd['search']} {search_term}"
-            result = await self._run_command(search_cmd, timeout=60)
+            search_cmd = [*self._argv['search'], search_term]
+            # Limit output for readability
+            result = await self._run_command(search_cmd, timeout=60, max_lines=20)
             
             if result['returncode'] == 0:
-                # Limit output for readability
-                lines = result['stdout'].split('\n')[:20]
-                return f"Search results for '{search_term}':\n" + '\n'.join(lines)
+                return f"Search results for '{search_term}':\n" + result['stdout'].rstrip('\n')
             else:
                 return f"Search failed: {result['stderr']}"
             
@@ -517,15 +1250,14 @@ Be specific about commands and safety measures. Only suggest safe operations.
     async def _rule_list_installed(self, command: str) -> str:
         """List installed packages with async processing"""
         try:
-            list_cmd = self.primary_cmd['list']
-            result = await self._run_command(list_cmd, timeout=60)
+            list_cmd = list(self._argv['list'])
+            result = await self._run_command(list_cmd, timeout=60, max_lines=20)
             
             if result['returncode'] == 0:
-                # Count packages and show first 20
-                lines = result['stdout'].split('\n')
-                package_count = len([line for line in lines if line.strip()])
-            
-                return f"Found {package_count} installed packages (showing first 20):\n" + '\n'.join(lines[:20])
+                # Count from the cached installed set and show only the first 20 lines
+                package_count = len(await self._installed_set())
+                
+                return f"Found {package_count} installed packages (showing first 20):\n" + result['stdout'].rstrip('\n')
             else:
                 return f"Failed to list packages: {result['stderr']}"
             
@@ -542,10 +1274,10 @@ Be specific about commands and safety measures. Only suggest safe operations.
             if await self._is_package_installed(package_name):
                 # Try to get version info
                 try:
-                    version_result = await self._run_command(f"{package_name} --version", timeout=10)
+                    version_result = await self._run_command([package_name, '--version'], timeout=10, idempotent=True)
                     if version_result['returncode'] == 0:
                         return f"{package_name} is installed: {version_result['stdout'].strip()}"
-                else:
+                    else:
                         return f"{package_name} is installed but version check failed"
                 except:
                     return f"{package_name} is installed"
@@ -559,220 +1291,116 @@ Be specific about commands and safety measures. Only suggest safe operations.
         """Rollback installation (placeholder for future implementation)"""
         return "Rollback functionality not yet implemented"
     
-    async def _rule_install_docker(self, command: str) -> str:
-        """Install Docker using template with async processing"""
-        try:
-            template = self.install_templates['docker']
-            
-            if await self._is_package_installed('docker'):
-                return "Docker is already installed"
-            
-            results = []
-            
-            for cmd in template['commands']:
-                if not self.config['dry_run']:
-                    result = await self._run_command(cmd, timeout=300)
-                    
-                    if result['returncode'] != 0:
-                        return f"Docker installation failed at step: {cmd}\nError: {result['stderr']}"
-                    
-                    results.append(f"✓ {cmd}")
-                else:
-                    results.append(f"Dry run: {cmd}")
-            
-            # Post-installation
-            if not self.config['dry_run'] and template.get('post_install'):
-                await self._run_command(template['post_install'], timeout=60)
-            
-            # Verify
-            if not self.config['dry_run']:
-                verify_result = await self._run_command(template['verify'], timeout=10)
-                if verify_result['returncode'] == 0:
-                    self.stats['packages_installed'] += 1
-                    return f"Docker installed successfully!\n" + '\n'.join(results)
-                else:
-                    return f"Docker installation completed but verification failed"
-            else:
-                return f"Dry run: Would install Docker\n" + '\n'.join(results)
-            
-        except Exception as e:
-            self.stats['failed_installations'] += 1
-            return f"Docker installation error: {str(e)}"
+    def _get_known_installs(self) -> Dict[str, Dict]:
+        """Load the on-disk record of template installs once per agent"""
+        if self._known_installs is None:
+            try:
+                raw = self.config['installed_cache_path'].read_bytes()
+                self._known_installs = orjson.loads(raw) if ORJSON_AVAILABLE else json.loads(raw)
+            except (OSError, ValueError):
+                self._known_installs = {}
+        
+        return self._known_installs
     
-    async def _rule_install_nodejs(self, command: str) -> str:
-        """Install Node.js using template with async processing"""
+    async def _save_known_installs(self):
+        """Persist the template install record without blocking the event loop"""
+        loop = asyncio.get_running_loop()
         try:
-            template = self.install_templates['nodejs']
-            
-            # Check if already installed
-            check_result = await self._run_command('node --version', timeout=10)
-            if check_result['returncode'] == 0:
-                return f"Node.js is already installed: {check_result['stdout'].strip()}"
-            
-            results = []
-            
-            for cmd in template['commands']:
-                if not self.config['dry_run']:
-                    result = await self._run_command(cmd, timeout=300)
-                    
-                    if result['returncode'] != 0:
-                        return f"Node.js installation failed at step: {cmd}\nError: {result['stderr']}"
-                    
-                    results.append(f"✓ {cmd}")
-                else:
-                    results.append(f"Dry run: {cmd}")
-            
-            # Post-installation
-            if not self.config['dry_run'] and template.get('post_install'):
-                await self._run_command(template['post_install'], timeout=60)
-            
-            # Verify
-            if not self.config['dry_run']:
-                verify_result = await self._run_command(template['verify'], timeout=10)
-                if verify_result['returncode'] == 0:
-                    self.stats['packages_installed'] += 1
-                    return f"Node.js installed successfully: {verify_result['stdout'].strip()}\n" + '\n'.join(results)
-                else:
-                    return f"Node.js installation completed but verification failed"
-            else:
-                return f"Dry run: Would install Node.js\n" + '\n'.join(results)
-            
-        except Exception as e:
-            self.stats['failed_installations'] += 1
-            return f"Node.js installation error: {str(e)}"
+            await loop.run_in_executor(
+                None, _write_json, self.config['installed_cache_path'], dict(self._get_known_installs())
+            )
+        except OSError as e:
+            self.logger.warning(f"Could not save installed cache: {e}")
     
-    async def _rule_install_python(self, command: str) -> str:
-        """Install Python using template with async processing"""
-        try:
-            template = self.install_templates['python']
-            
-            # Check if already installed
-            check_result = await self._run_command('python3 --version', timeout=10)
-            if check_result['returncode'] == 0:
-                return f"Python is already installed: {check_result['stdout'].strip()}"
-            
-            results = []
-            
-            for cmd in template['commands']:
-                if not self.config['dry_run']:
-                    result = await self._run_command(cmd, timeout=300)
-                    
-                    if result['returncode'] != 0:
-                        return f"Python installation failed at step: {cmd}\nError: {result['stderr']}"
-                    
-                    results.append(f"✓ {cmd}")
-                else:
-                    results.append(f"Dry run: {cmd}")
-            
-            # Post-installation
-            if not self.config['dry_run'] and template.get('post_install'):
-                await self._run_command(template['post_install'], timeout=60)
-            
-            # Verify
-            if not self.config['dry_run']:
-                verify_result = await self._run_command(template['verify'], timeout=10)
-                if verify_result['returncode'] == 0:
-                    self.stats['packages_installed'] += 1
-                    return f"Python installed successfully: {verify_result['stdout'].strip()}\n" + '\n'.join(results)
-                else:
-                    return f"Python installation completed but verification failed"
-            else:
-                return f"Dry run: Would install Python\n" + '\n'.join(results)
-            
-        except Exception as e:
-            self.stats['failed_installations'] += 1
-            return f"Python installation error: {str(e)}"
+    async def _remember_install(self, key: str, verify: List[str], version: str):
+        """Record a verified template install"""
+        self._get_known_installs()[key] = {
+            'version': version,
+            'installed_at': datetime.now().isoformat(),
+            'verify_cmd': shlex.join(verify)
+        }
+        await self._save_known_installs()
     
-    async def _rule_install_java(self, command: str) -> str:
-        """Install Java using template with async processing"""
-        try:
-            template = self.install_templates['java']
-            
-            # Check if already installed
-            check_result = await self._run_command('java -version', timeout=10)
-            if check_result['returncode'] == 0:
-                return f"Java is already installed: {check_result['stderr'].strip()}"  # Java outputs version to stderr
-            
-            results = []
-            
-            for cmd in template['commands']:
-                if not self.config['dry_run']:
-                    result = await self._run_command(cmd, timeout=300)
-                    
-                    if result['returncode'] != 0:
-                        return f"Java installation failed at step: {cmd}\nError: {result['stderr']}"
-                    
-                    results.append(f"✓ {cmd}")
-                else:
-                    results.append(f"Dry run: {cmd}")
-            
-            # Verify
-            if not self.config['dry_run']:
-                verify_result = await self._run_command(template['verify'], timeout=10)
-                if verify_result['returncode'] == 0:
-                    self.stats['packages_installed'] += 1
-                    return f"Java installed successfully!\n" + '\n'.join(results)
-                else:
-                    return f"Java installation completed but verification failed"
-            else:
-                return f"Dry run: Would install Java\n" + '\n'.join(results)
-            
-        except Exception as e:
-            self.stats['failed_installations'] += 1
-            return f"Java installation error: {str(e)}"
+    async def _forget_installs(self):
+        """Drop the template install record after the package set changed"""
+        if self._get_known_installs():
+            self._known_installs.clear()
+            await self._save_known_installs()
+    
+    @staticmethod
+    def _parse_version(key: str, result: Dict) -> str:
+        """Pull the version number out of a template's verify output"""
+        # Some tools (java) print their version to stderr
+        output = (result['stdout'] or result['stderr']).strip()
+        pattern = _VERIFY_RE.get(key)
+        match = pattern.search(output) if pattern else None
+        return match.group(1) if match else output
     
-    async def _rule_install_git(self, command: str) -> str:
-        """Install Git using template with async processing"""
+    async def _install_from_template(self, key: str, command: str) -> InstallResult:
+        """Install software from one of the install_templates"""
+        template = self.install_templates.get(key)
+        if template is None:
+            return InstallResult(False, f"No install template for {key}")
+        
+        name = template.name
+        verify = template.verify
+        
         try:
-            template = self.install_templates['git']
-            
-            # Check if already installed
-            check_result = await self._run_command('git --version', timeout=10)
-            if check_result['returncode'] == 0:
-                return f"Git is already installed: {check_result['stdout'].strip()}"
+            # A PATH scan rules out a missing tool without spawning anything
+            if shutil.which(verify[0]):
+                # Trust a recorded install while its binary is still on PATH
+                known = self._get_known_installs().get(key)
+                if known and known.get('verify_cmd') == shlex.join(verify):
+                    return InstallResult(True, f"{name} is already installed: {known['version']}")
+                
+                # Only run the verify command when we need its version string
+                check_result = await self._run_command(verify, timeout=10, idempotent=True)
+                if check_result['returncode'] == 0:
+                    version = self._parse_version(key, check_result)
+                    await self._remember_install(key, verify, version)
+                    return InstallResult(True, f"{name} is already installed: {version}")
             
-            results = []
+            results, failure = await self._run_template_steps(template)
+            if failure:
+                cmd, result = failure
+                return InstallResult(False, f"{name} installation failed at step: {cmd}\nError: {result['stderr']}")
             
-            for cmd in template['commands']:
-                if not self.config['dry_run']:
-                    result = await self._run_command(cmd, timeout=300)
-                    
-                    if result['returncode'] != 0:
-                        return f"Git installation failed at step: {cmd}\nError: {result['stderr']}"
-                    
-                    results.append(f"✓ {cmd}")
-                else:
-                    results.append(f"Dry run: {cmd}")
+            if self.config['dry_run']:
+                return InstallResult(True, '\n'.join((f"Dry run: Would install {name}", *results)))
             
-            # Post-installation
-            if not self.config['dry_run'] and template.get('post_install'):
-                await self._run_command(template['post_install'], timeout=60)
+            # Post-installation and verification don't depend on each other, so run them together
+            verify_coro = self._run_command(verify, timeout=10)
+            if template.post_install:
+                _, verify_result = await asyncio.gather(
+                    self._run_command(template.post_install, timeout=60, capture_output=False),
+                    verify_coro
+                )
+            else:
+                verify_result = await verify_coro
             
-            # Verify
-            if not self.config['dry_run']:
-                verify_result = await self._run_command(template['verify'], timeout=10)
-                if verify_result['returncode'] == 0:
-                    self.stats['packages_installed'] += 1
-                    return f"Git installed successfully: {verify_result['stdout'].strip()}\n" + '\n'.join(results)
-                else:
-                    return f"Git installation completed but verification failed"
+            self._store_probe(self._probe_key(verify), verify_result)
+            if verify_result['returncode'] == 0:
+                self.stats['packages_installed'] += 1
+                version = self._parse_version(key, verify_result)
+                await self._remember_install(key, verify, version)
+                return InstallResult(True, '\n'.join((f"{name} installed successfully: {version}", *results)))
             else:
-                return f"Dry run: Would install Git\n" + '\n'.join(results)
+                return InstallResult(False, f"{name} installation completed but verification failed")
             
         except Exception as e:
             self.stats['failed_installations'] += 1
-            return f"Git installation error: {str(e)}"
+            return InstallResult(False, f"{name} installation error: {str(e)}")
+    
+    async def shutdown(self):
+        """Close the shared HTTP session before the base shutdown"""
+        if self._http is not None and not self._http.closed:
+            await self._http.close()
+        
+        await super().shutdown()
     
     def get_stats(self) -> Dict:
         """Get agent statistics"""
-                return {
-            'agent': self.name,
-            'stats': self.stats,
-            'config': self.config,
-            'package_manager': self.primary_manager,
-            'available_managers': self.package_managers,
-            'install_templates': list(self.install_templates.keys())
-        }
+        return {**self._stats_base, 'stats': self.stats}
 
 
 # Testing interface